@@ -3,6 +3,7 @@ import typing as tp
 import math
 
 import PIL
+import numpy as np
 import xlsxwriter
 import pandas as pd
 from pandas.api.types import is_integer_dtype, is_float_dtype
@@ -12,24 +13,69 @@ from .utils import PIL2IOBytes
 
 
 class BaseExcelReporter:
+    """With ``constant_memory=True`` (default) rows are flushed as soon as a
+    later row is written: writing above the last written row of the sheet,
+    e.g. a table beside a previous one via ``shift=(0, k)``, raises
+    ValueError. Pass ``constant_memory=False`` for such layouts.
+    """
     CELL_WIDTH = 8.43  # 64 pixels - default Excel cell width
     PIXEL_CELL_WIDTH = 64
     PIXEL_ROW_HEIGHT = 20
     PIXEL_TO_WIDTH_RATIO = CELL_WIDTH / PIXEL_CELL_WIDTH
     PIXEL_CHAR_WIDTH = int(8 * 1.125)
+    WIDTH_EPS = 1e-3  # smaller column width changes are not applied
 
     def __init__(self, excel_path,
                  pixel_sheet_width=1200,
                  max_cell_width=24,
-                 min_cell_width=3.5):
+                 min_cell_width=3.5,
+                 constant_memory=True,
+                 tmpdir=None):
         self.PIXEL_SHEET_WIDTH = pixel_sheet_width
         self.MAX_CELL_WIDTH = max_cell_width
         self.MIN_CELL_WIDTH = min_cell_width
         self.excel_path = excel_path
-        self._wb = xlsxwriter.Workbook(excel_path)
+        self.constant_memory = constant_memory
+        self._wb = xlsxwriter.Workbook(excel_path,
+                                       {'constant_memory': constant_memory,
+                                        'tmpdir': tmpdir})
         self._wb.nan_inf_to_errors = True
         self._sheet = None
-        self._cursor = None
+        self._sheets: tp.Dict[str, xlsxwriter.worksheet.Worksheet] = {}
+        self._last_rows: tp.Dict[str, int] = {}  # last written row per sheet
+        self._cursor_row = None
+        self._cursor_col = None
+        self._format_cache: tp.Dict[tuple, xlsxwriter.workbook.Format] = {}
+
+    @classmethod
+    def __freeze(cls, value) -> tp.Hashable:
+        if isinstance(value, dict):
+            return tuple(sorted((k, cls.__freeze(v)) for k, v in value.items()))
+        if isinstance(value, (list, tuple)):
+            return tuple(cls.__freeze(v) for v in value)
+        return value
+
+    def _fmt(self, format) -> xlsxwriter.workbook.Format:
+        """Shared Format for dict of properties, must not be modified"""
+        key = self.__freeze(format or {})
+        if key not in self._format_cache:
+            self._format_cache[key] = self._wb.add_format(format or {})
+        return self._format_cache[key]
+
+    def _fmt_or_none(self, format) -> tp.Optional[xlsxwriter.workbook.Format]:
+        """Same as `_fmt`, but None for empty properties"""
+        if not format:
+            return None
+        return self._fmt(format)
+
+    @property
+    def _cursor(self) -> tp.List[int]:
+        """[row, col] copy of the cursor"""
+        return [self._cursor_row, self._cursor_col]
+
+    @_cursor.setter
+    def _cursor(self, cursor) -> None:
+        self._cursor_row, self._cursor_col = cursor
 
     def close(self):
         self._wb.close()
@@ -52,22 +98,39 @@ class BaseExcelReporter:
         default_cell : dict of style cells. Read about Format in xlsx docs
         """
         self._sheet = self._wb.add_worksheet(name)
-        cell_format = self._wb.add_format(default_cell_format)
+        self._sheets[name] = self._sheet
+        cell_format = self._fmt_or_none(default_cell_format)
         self._sheet.set_column('A:ZZ', self.CELL_WIDTH, cell_format)
-        self.default_cell_format = self._wb.add_format(default_cell_format)
+        self.default_cell_format = cell_format
         self.set_active_sheet(name)
 
-    def set_active_sheet(self, name, cursor=[0, 0]) -> None:
-        self._sheet, self._cursor = self._wb.sheetnames[name], cursor
+    def set_active_sheet(self, name, cursor=None) -> None:
+        self._sheet = self._sheets[name]
+        self._cursor_row, self._cursor_col = (0, 0) if cursor is None else cursor
 
     def apply_shift(self, shift) -> None:
-        self._cursor[0] += shift[0]
-        self._cursor[1] += shift[1]
+        self._cursor_row += shift[0]
+        self._cursor_col += shift[1]
+
+    def _check_row(self, row) -> None:
+        """Raises ValueError if row is already flushed"""
+        name = self._sheet.name
+        written = self._last_rows.get(name, 0)
+        if self.constant_memory and row < written:
+            raise ValueError(f"Can't write to row {row} of sheet '{name}': "
+                             f"rows above the last written row {written} are "
+                             "already flushed with constant_memory=True")
+
+    def _set_written(self, row) -> None:
+        name = self._sheet.name
+        self._last_rows[name] = max(self._last_rows.get(name, 0), row)
 
     def _text(self, string, format=None, shift=(2, 0)) -> None:
-        text_pos = (self._cursor[0], self._cursor[1])
-        cur_format = self._wb.add_format(format)
+        text_pos = (self._cursor_row, self._cursor_col)
+        cur_format = self._fmt_or_none(format)
+        self._check_row(self._cursor_row)
         self._sheet.write(*text_pos, string, cur_format)
+        self._set_written(self._cursor_row)
         self.apply_shift(shift)
 
     def __printed_text_height(self, text) -> int:
@@ -78,41 +141,49 @@ class BaseExcelReporter:
             height += 1
         return height
 
-    def __printed_value_width(self, value) -> float:
-        return len(str(value)) * self.PIXEL_CHAR_WIDTH * self.PIXEL_TO_WIDTH_RATIO
-
-    def __clip(self, value, lower, upper) -> numbers.Number:
-        return lower if value < lower else upper if value > upper else value
+    def __printed_values_width(self, values) -> tp.List[float]:
+        lengths = np.char.str_len(np.asarray(values).astype(str, copy=False))
+        widths = lengths * (self.PIXEL_CHAR_WIDTH * self.PIXEL_TO_WIDTH_RATIO)
+        return np.clip(widths, self.MIN_CELL_WIDTH, self.MAX_CELL_WIDTH).tolist()
 
     def _textbox(self, text, title=None,
                  header_format={}, textbox_format={}, shift=None) -> None:
         text_height = self.__printed_text_height(text)
-        box_pos = self._cursor[0] + 1, self._cursor[1]
+        if title is not None:
+            self._check_row(self._cursor_row)
+        box_pos = self._cursor_row + 1, self._cursor_col
         self._sheet.insert_textbox(*box_pos, text,
                                    {'width': self.PIXEL_SHEET_WIDTH,
                                     'height': text_height * self.PIXEL_ROW_HEIGHT,
                                     'object_position': 1,
                                     **textbox_format})
         if title is not None:
-            self._cursor_anchor = self._cursor.copy()
-            self._text(title, header_format, shift=[0, 1])
             cell_header = len(str(title)) * \
                 self.PIXEL_CHAR_WIDTH // self.PIXEL_CELL_WIDTH
-            for _ in range(max(3, cell_header)):
-                self._text('', header_format, shift=[0, 1])
-            self._cursor = self._cursor_anchor
+            self._sheet.write_row(self._cursor_row, self._cursor_col,
+                                  [title] + [''] * max(3, cell_header),
+                                  self._fmt_or_none(header_format))
+            self._set_written(self._cursor_row)
         if shift is None:
             shift = (text_height + 2, 0)
         self.apply_shift(shift)
 
+    def _fit_scale(self, size, max_pixel_size) -> float:
+        return min(1, *(lim / cur for cur, lim in zip(size, max_pixel_size)))
+
     def _image(self, image: PIL.Image, image_name,
                max_pixel_size=(450, 800), image_options={},
-               shift=None) -> None:
-        scales = (lim / cur for cur, lim in zip(image.size, max_pixel_size))
-        scale = min(1, *scales)
-        im_pos = (self._cursor[0], self._cursor[1])
+               shift=None, image_data=None, compress_level=None) -> None:
+        """image_data : encoded `image` to insert instead of encoding it again
+        compress_level : png compression level (0-9) used to encode `image`,
+            no effect if `image_data` is given"""
+        scale = self._fit_scale(image.size, max_pixel_size)
+        if image_data is None:
+            image_data = PIL2IOBytes(image, compress_level=compress_level)
+        image_data.seek(0)
+        im_pos = (self._cursor_row, self._cursor_col)
         self._sheet.insert_image(*im_pos, image_name,
-                                 {'image_data': PIL2IOBytes(image),
+                                 {'image_data': image_data,
                                   'x_scale': scale,
                                   'y_scale': scale,
                                   'object_position': 3,
@@ -130,17 +201,12 @@ class BaseExcelReporter:
             return self._sheet.col_info[col][0]
         return self.CELL_WIDTH
 
-    def __adjust_col_width(self, col_ind, text, col_format) -> None:
-        text_len = self.__printed_value_width(text)
-        width = self.__clip(text_len, self.MIN_CELL_WIDTH, self.MAX_CELL_WIDTH)
-        self._sheet.set_column(col_ind, col_ind, width, col_format)
-
-    def __get_number_format(self, col_name, df):
+    def __get_number_format(self, col_name, dtype):
         if isinstance(col_name, str) and ('%' in col_name):
             return {'num_format': '0.00%'}
-        if is_integer_dtype(df[col_name]):
+        if is_integer_dtype(dtype):
             return {'num_format': '0'}
-        elif is_float_dtype(df[col_name]):
+        elif is_float_dtype(dtype):
             return {'num_format': '0.000'}
         else:
             return None
@@ -150,42 +216,59 @@ class BaseExcelReporter:
             return value
         return str(value)
 
-    def __get_table_item_format(self, cur_row, cur_col, df):
-        num_format = self.__get_number_format(df.columns[cur_col], df)
-        cur_format = self._wb.add_format(num_format)
-        if (cur_row == len(df) - 1) and (cur_col == len(df.columns) - 1):
-            cur_format.set_bottom()
-            cur_format.set_right()
-        elif (cur_row == len(df) - 1):
-            cur_format.set_bottom()
-        elif (cur_col == len(df.columns) - 1):
-            cur_format.set_right()
-        return cur_format
+    def __is_numeric(self, values) -> bool:
+        return isinstance(values.dtype, np.dtype) and values.dtype.kind in 'iuf'
+
+    def __get_column_values(self, series) -> tp.Tuple[list, tp.Callable]:
+        """Returns column values and the worksheet method writing them"""
+        if self.__is_numeric(series):
+            return series.to_numpy().tolist(), self._sheet.write_number
+        values = [self.__cast_to_str_except_numbers(value)
+                  for value in series.to_numpy(dtype=object)]
+        return values, self._sheet.write
+
+    def __get_column_formats(self, col_name, dtype):
+        """Formats of a column's cells: (body, last row, last column, corner)"""
+        num_format = self.__get_number_format(col_name, dtype) or {}
+        return (self._fmt(num_format),
+                self._fmt({**num_format, 'bottom': 1}),
+                self._fmt({**num_format, 'right': 1}),
+                self._fmt({**num_format, 'bottom': 1, 'right': 1}))
 
     def _table(self, df: pd.DataFrame,
                table_column_format,
                table_index_format,
                shift=None) -> None:
-        col_format = self._wb.add_format(table_column_format)
-        for j, col_name in enumerate(df.columns):
-            cur_width = self.__get_col_width(j + self._cursor[1] + 1)
-            need_width = self.__printed_value_width(col_name)
-            if cur_width < need_width:
-                self.__adjust_col_width(j + self._cursor[1] + 1,
-                                        col_name, self.default_cell_format)
-            self._sheet.write(self._cursor[0], j + self._cursor[1] + 1,
-                              col_name, col_format)
-
-        ind_format = self._wb.add_format(table_index_format)
-        for i, (index, values) in enumerate(df.iterrows()):
-            self._sheet.write(self._cursor[0] + i + 1, self._cursor[1],
-                              index, ind_format)
-            for j, val in enumerate(values):
-                cur_format = self.__get_table_item_format(i, j, df)
-                self._sheet.write(self._cursor[0] + i + 1,
-                                  self._cursor[1] + j + 1,
-                                  self.__cast_to_str_except_numbers(val),
-                                  cur_format)
+        row0, col0 = self._cursor_row, self._cursor_col
+        self._check_row(row0)
+        col_format = self._fmt(table_column_format)
+        col_names = list(df.columns)
+        widths = self.__printed_values_width(col_names)
+        for j, width in enumerate(widths):
+            col = col0 + j + 1
+            if width - self.__get_col_width(col) > self.WIDTH_EPS:
+                self._sheet.set_column(col, col, width, self.default_cell_format)
+        self._sheet.write_row(row0, col0 + 1, col_names, col_format)
+
+        ind_format = self._fmt(table_index_format)
+        if self.__is_numeric(df.index):
+            idx, write_index = df.index.to_numpy().tolist(), self._sheet.write_number
+        else:
+            idx, write_index = df.index.to_numpy(dtype=object), self._sheet.write
+        cols, writers, col_formats = [], [], []
+        for col_name, series in df.items():
+            values, writer = self.__get_column_values(series)
+            cols.append(values)
+            writers.append(writer)
+            col_formats.append(self.__get_column_formats(col_name, series.dtype))
+        nrows, ncols = len(idx), len(cols)
+        for i in range(nrows):
+            write_index(row0 + i + 1, col0, idx[i], ind_format)
+            is_last_row = i == nrows - 1
+            for j in range(ncols):
+                cur_format = col_formats[j][is_last_row | ((j == ncols - 1) << 1)]
+                writers[j](row0 + i + 1, col0 + j + 1, cols[j][i], cur_format)
+        self._set_written(row0 + nrows)
         if shift is None:
-            shift = (len(df) + 2, 0)
+            shift = (len(idx) + 2, 0)
         self.apply_shift(shift)
@@ -1,12 +1,38 @@
 import typing as tp
+import os
 import json
+import copy
+import functools
+from pathlib import Path
 
 import xlsxwriter
 import PIL
 import pandas as pd
 
 from .base_excel_reporter import BaseExcelReporter
-from .utils import get_project_root
+from .utils import get_project_root, PIL2IOBytes
+
+
+def _file_key(path) -> tp.Tuple[Path, int]:
+    return Path(path).resolve(), os.stat(path).st_mtime_ns
+
+
+@functools.lru_cache(maxsize=8)
+def _load_theme(theme_path: Path, mtime_ns: int,
+                necessary_keys: tp.Tuple[str]) -> dict:
+    with open(theme_path, 'r') as f:
+        formats = json.load(f)
+        for key in necessary_keys:
+            if key not in formats:
+                raise ValueError(f"""Theme json-file should contain keys:{list(necessary_keys)}.
+                                     define format for {key}""")
+    return formats
+
+
+@functools.lru_cache(maxsize=8)
+def _load_logo(logo_path: Path, mtime_ns: int) -> PIL.Image.Image:
+    with PIL.Image.open(logo_path) as image:
+        return image.copy()
 
 
 class ExcelReporter(BaseExcelReporter):
@@ -23,41 +49,61 @@ class ExcelReporter(BaseExcelReporter):
                  logo_path=get_project_root() / 'images/gpb_logo_white.png',
                  pixel_sheet_width=1200,
                  max_cell_width=24,
-                 min_cell_width=3.5
+                 min_cell_width=3.5,
+                 constant_memory=True,
+                 tmpdir=None
                  ):
-        super().__init__(excel_path, pixel_sheet_width, max_cell_width, min_cell_width)
+        super().__init__(excel_path, pixel_sheet_width, max_cell_width,
+                         min_cell_width, constant_memory, tmpdir)
         self._formats = self._read_theme(theme_path)
-        self.logo_image = PIL.Image.open(logo_path)
+        self.logo_image = _load_logo(*_file_key(logo_path)).copy()
+
+    @property
+    def logo_image(self) -> PIL.Image.Image:
+        return self._logo_image
+
+    @logo_image.setter
+    def logo_image(self, image) -> None:
+        self._logo_image = image
+        self._logo_cache = {}  # scaled logo and its png bytes per size
 
     def _read_theme(self, theme_path) -> tp.List[xlsxwriter.workbook.Format]:
-        formats = {}
-        with open(theme_path, 'r') as f:
-            formats = json.load(f)
-            for key in self.NECESSARY_FORMAT_KEYS:
-                if key not in formats:
-                    raise ValueError(f"""Theme json-file should contain keys:{self.NECESSARY_FORMAT_KEYS}.
-                                         define format for {key}""")
-        return formats
+        formats = _load_theme(*_file_key(theme_path), tuple(self.NECESSARY_FORMAT_KEYS))
+        return copy.deepcopy(formats)
+
+    def _get_scaled_logo(self, max_pixel_size):
+        scale = self._fit_scale(self.logo_image.size, max_pixel_size)
+        size = tuple(max(1, round(cur * scale)) for cur in self.logo_image.size)
+        if size not in self._logo_cache:
+            logo = self.logo_image.convert('RGBA').resize(size, PIL.Image.LANCZOS)
+            self._logo_cache[size] = logo, PIL2IOBytes(logo)
+        return self._logo_cache[size]
 
     def _set_logo_title(self, title, sheet_name,
                         title_cell_height=2, logo_cell_width=2,
                         logo_offset={"x_offset": 8, "y_offset": 8},
                         title_prefix=' '):
-        cur_format = self._wb.add_format(self._formats['sheet_title'])
+        cur_format = self._fmt(self._formats['sheet_title'])
+        self._check_row(0)
         for i in range(title_cell_height):
             self._sheet.set_row(i, cell_format=cur_format)
+            # constant_memory keeps a set_row-only row only if the next
+            # write is on the row after it, so each row gets a cell
+            self._sheet.write_blank(i, 0, None, cur_format)
+        self._set_written(title_cell_height - 1)
         logo_h = self.PIXEL_ROW_HEIGHT * \
             title_cell_height - 2 * logo_offset['x_offset']
         logo_w = self.PIXEL_CELL_WIDTH * \
             logo_cell_width - 2 * logo_offset['y_offset']
-        self._image(self.logo_image, f'logo_{sheet_name}',
-                    max_pixel_size=(logo_w, logo_h),
+        logo, logo_bytes = self._get_scaled_logo((logo_w, logo_h))
+        self._image(logo, f'logo_{sheet_name}',
+                    max_pixel_size=logo.size,
                     image_options=logo_offset,
-                    shift=(0, 0))
-        self._cursor = [title_cell_height - 1, logo_cell_width]
+                    shift=(0, 0), image_data=logo_bytes)
+        self._cursor_row, self._cursor_col = title_cell_height - 1, logo_cell_width
         self._text(title_prefix + title, self._formats['sheet_title'],
                    shift=(0, 0))
-        self._cursor = [title_cell_height, 1]
+        self._cursor_row, self._cursor_col = title_cell_height, 1
 
     def create_titled_sheet(self, sheet_name, title, description,
                             title_cell_height=2, logo_cell_width=2,
@@ -71,8 +117,9 @@ class ExcelReporter(BaseExcelReporter):
 
     def insert_image(self, image: PIL.Image, image_name,
                      max_pixel_size=(450, 800), image_options={},
-                     shift=None):
-        self._image(image, image_name, max_pixel_size, image_options, shift)
+                     shift=None, compress_level=None):
+        self._image(image, image_name, max_pixel_size, image_options, shift,
+                    compress_level=compress_level)
 
     def insert_table(self, df: pd.DataFrame, shift=None):
         self._table(df, self._formats['table_columns'],
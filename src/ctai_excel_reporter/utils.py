@@ -12,9 +12,13 @@ def plt2PIL(fig):
     return pil_image
 
 
-def PIL2IOBytes(pil_image, format='png'):
+def PIL2IOBytes(pil_image, format='png', compress_level=None):
+    # low png compress_level trades a bit larger file for much faster encoding
+    if compress_level is None:
+        compress_level = 1
     buf = io.BytesIO()
-    pil_image.save(buf, format=format)
+    pil_image.save(buf, format=format, compress_level=compress_level,
+                   optimize=False)
     return buf
 
 